@@ -40,15 +40,15 @@ RTM_consts = {
 
 
 # Sodium ion-channel rate functions
-_alpha_m = 0.32 * ( 54.0 + _V_m ) / ( 1 - sym.exp( -1 * ( _V_m + 54.0 ) / 4.0 ) )
-_beta_m = 0.28 * ( 27.0 + _V_m ) / ( sym.exp( ( _V_m + 27.0 ) / 5.0 ) - 1 )
+_alpha_m = -0.32 * ( 54.0 + _V_m ) / expm1( -1 * ( _V_m + 54.0 ) / 4.0 )
+_beta_m = 0.28 * ( 27.0 + _V_m ) / expm1( ( _V_m + 27.0 ) / 5.0 )
 
 # leak channel rate values
 _alpha_h = 0.128 * sym.exp( - ( _V_m + 50.0 ) / 18 )
 _beta_h = 4.0 / ( 1 + sym.exp( -1.0 * ( _V_m + 27.0 ) / 5.0 ))
 
 # Potassium ion-channel rate functions
-_alpha_n = 0.032 * ( 52.0 + _V_m ) / ( 1 - sym.exp( -1 * ( _V_m + 52.0 ) / 5.0 ))
+_alpha_n = -0.032 * ( 52.0 + _V_m ) / expm1( -1 * ( _V_m + 52.0 ) / 5.0 )
 _beta_n = 0.5 * sym.exp( - ( _V_m + 57.0 ) / 40.0 )
 
 
@@ -63,8 +63,8 @@ _tau_w = 400 / ( 3.3 * sym.exp( ( _V_m + 35.0) / 20.0 ) + sym.exp( -1 * ( _V_m +
 # Wang-Buzsaki model expressions
 
 # currents
-_I_K = _g_K * ( _n ** 4.0) * ( _V_m - _E_K )
-_I_Na = _g_Na * ( _m_inf ** 3.0 ) * _h * (_V_m - _E_Na)
+_I_K = _g_K * ( _n ** 4) * ( _V_m - _E_K )
+_I_Na = _g_Na * ( _m_inf ** 3 ) * _h * (_V_m - _E_Na)
 _I_L = _g_L * (_V_m - _E_L)
 _I_M = _g_M * _w * ( _V_m - _E_K )
 
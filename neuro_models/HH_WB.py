@@ -37,7 +37,7 @@ WB_consts = {
 }
 
 # Sodium ion-channel rate functions
-_alpha_m = 0.1 * ( 35.0 + _V_m ) / ( 1 - sym.exp( -1 * ( _V_m + 35.0 ) / 10.0 ))
+_alpha_m = -0.1 * ( 35.0 + _V_m ) / expm1( -1 * ( _V_m + 35.0 ) / 10.0 )
 _beta_m = 4.0 * sym.exp( - ( _V_m + 60.0 ) / 18.0 )
 
 # leak channel rate values
@@ -45,7 +45,7 @@ _alpha_h = 0.35 * sym.exp( - ( _V_m + 58.0 ) / 20 )
 _beta_h = 5.0 / ( 1 + sym.exp( -0.1 * ( _V_m + 28.0 ) ))
 
 # Potassium ion-channel rate functions
-_alpha_n = 0.05 * ( 34.0 + _V_m ) / ( 1 - sym.exp( -0.1 * ( _V_m + 34.0 )) )
+_alpha_n = -0.05 * ( 34.0 + _V_m ) / expm1( -0.1 * ( _V_m + 34.0 ) )
 _beta_n = 0.625 * sym.exp( - ( _V_m + 44.0 ) / 80.0 )
 
 def get_model():
@@ -57,8 +57,8 @@ def get_model():
 	_h_inf = _alpha_h / ( _alpha_h + _beta_h )
 
 	# currents
-	_I_K = _g_K * (_n ** 4.0) * ( _V_m - _E_K )
-	_I_Na = _g_Na * ( _m_inf ** 3.0 ) * _h * (_V_m - _E_Na)
+	_I_K = _g_K * (_n ** 4) * ( _V_m - _E_K )
+	_I_Na = _g_Na * ( _m_inf ** 3 ) * _h * (_V_m - _E_Na)
 	_I_L = _g_L * (_V_m - _E_L)
 
 	# diffeqs
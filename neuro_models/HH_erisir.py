@@ -8,7 +8,11 @@ import numpy as np
 import sympy as sym
 from scipy.integrate import odeint
 from copy import deepcopy
+from functools import lru_cache
 
+from numba import njit, cfunc, prange, vectorize, types
+
+from neuro_models import neuroUtil
 from neuro_models.neuroUtil import *
 
 # Average potassium, sodium, leak channel conductance per unit area (mS/cm^2)
@@ -40,15 +44,15 @@ HHE_consts = {
 
 
 # Sodium ion-channel rate functions
-_alpha_m = 40 * ( 75.5 - _V_m ) / ( sym.exp( ( 75.5 - _V_m ) / 13.5 ) - 1)
+_alpha_m = 40 * ( 75.5 - _V_m ) / expm1( ( 75.5 - _V_m ) / 13.5 )
 _beta_m = 1.2262 * sym.exp( - _V_m  / 42.248 )
 
 # leak channel rate values
 _alpha_h = 0.0035 * sym.exp( - _V_m / 24.186 )
-_beta_h = -0.017 * ( _V_m + 51.25 ) / ( sym.exp( - ( _V_m + 51.25 ) / 5.2 ) - 1 )
+_beta_h = -0.017 * ( _V_m + 51.25 ) / expm1( - ( _V_m + 51.25 ) / 5.2 )
 
 # Potassium ion-channel rate functions
-_alpha_n = ( 95.0 - _V_m )/( sym.exp( ( 95.0 - _V_m ) / 11.8 ) - 1)
+_alpha_n = ( 95.0 - _V_m )/expm1( ( 95.0 - _V_m ) / 11.8 )
 _beta_n = 0.025 * sym.exp( - _V_m / 22.222 )
 
 
@@ -61,8 +65,8 @@ _h_inf = _alpha_h / ( _alpha_h + _beta_h )
 # Erisir model expressions
 
 # currents
-_I_K = _g_K * (_n ** 2.0) * ( _V_m - _E_K )
-_I_Na = _g_Na * ( _m_inf ** 3.0 ) * _h * (_V_m - _E_Na)
+_I_K = _g_K * (_n ** 2) * ( _V_m - _E_K )
+_I_Na = _g_Na * ( _m_inf ** 3 ) * _h * (_V_m - _E_Na)
 _I_L = _g_L * (_V_m - _E_L)
 
 # diffeqs
@@ -112,4 +116,496 @@ def get_model():
 		dict_syms = deepcopy(HHE_consts),
 		stim_sym_in = _I_A,
 		dict_units = None,
-	)
\ No newline at end of file
+	)
+
+
+
+#* numeric model
+# the sympy model above goes through `NM_model.solve`, which calls back into
+# python on every step. the functions below integrate the same equations with a
+# compiled RHS, so the time-step loop never enters the interpreter
+
+# stable state for `I_A = 0` (found via `NM_model.find_stable`)
+HHE_stable = np.array([
+	-69.8314360,
+	0.000244168416,
+	0.873198903,
+])
+
+# rate functions, compiled as ufuncs so a whole trace ( e.g. `alpha_n(Vy[:,0])` )
+# is evaluated in one compiled loop, and they can still be called per-point from
+# the cfunc RHS and the population kernels
+_rate_sig = [ 'float64(float64)' ]
+
+@vectorize(_rate_sig)
+def alpha_m(Vm):
+	return 40.0 * ( 75.5 - Vm ) / np.expm1( ( 75.5 - Vm ) / 13.5 )
+
+@vectorize(_rate_sig)
+def beta_m(Vm):
+	return 1.2262 * np.exp( - Vm / 42.248 )
+
+@vectorize(_rate_sig)
+def alpha_h(Vm):
+	return 0.0035 * np.exp( - Vm / 24.186 )
+
+@vectorize(_rate_sig)
+def beta_h(Vm):
+	return -0.017 * ( Vm + 51.25 ) / np.expm1( - ( Vm + 51.25 ) / 5.2 )
+
+@vectorize(_rate_sig)
+def alpha_n(Vm):
+	return ( 95.0 - Vm ) / np.expm1( ( 95.0 - Vm ) / 11.8 )
+
+@vectorize(_rate_sig)
+def beta_n(Vm):
+	return 0.025 * np.exp( - Vm / 22.222 )
+
+@vectorize(_rate_sig)
+def m_inf(Vm):
+	return alpha_m(Vm) / ( alpha_m(Vm) + beta_m(Vm) )
+
+
+#* rate lookup tables
+# V_m stays within roughly [-90, 60] mV, so the rates can be tabulated on a fine
+# grid and linearly interpolated, replacing an exp and a division with a load and
+# an FMA. enabled with `neuroUtil.USE_RATE_LUT`, which is read once, when this
+# module is imported, since every compiled RHS below is built on `_rates`
+
+_V_lut_min = -100.0
+_V_lut_max = 65.0
+_V_lut_dV = 0.01
+
+@njit
+def lookup(V, table, V_0 = _V_lut_min, dV = _V_lut_dV):
+	'''
+	linearly interpolate `table`, sampled every `dV` starting at `V_0`
+	`V` is clamped to the range of the table
+	'''
+	V = min(max(V, V_0), V_0 + dV * (len(table) - 2))
+	i = ( V - V_0 ) / dV
+	k = int(i)
+	f = i - k
+	return table[k] + f * ( table[k + 1] - table[k] )
+
+def _build_lut(func):
+	'''
+	tabulate `func` on the lookup grid
+	removable singularities ( 0/0 ) that land on the grid are filled from their neighbours
+	'''
+	V_grid = _V_lut_min + _V_lut_dV * np.arange(int(round(( _V_lut_max - _V_lut_min ) / _V_lut_dV)) + 1)
+	with np.errstate(invalid = 'ignore', divide = 'ignore'):
+		table = func(V_grid)
+	idx_bad = np.flatnonzero(~np.isfinite(table))
+	table[idx_bad] = 0.5 * ( table[idx_bad - 1] + table[idx_bad + 1] )
+	return table
+
+
+# `_rates` gives ( alpha_n, beta_n, m_inf, alpha_h, beta_h ) for the compiled RHS functions
+if neuroUtil.USE_RATE_LUT:
+	_ALPHA_N_LUT = _build_lut(alpha_n)
+	_BETA_N_LUT = _build_lut(beta_n)
+	_M_INF_LUT = _build_lut(m_inf)
+	_ALPHA_H_LUT = _build_lut(alpha_h)
+	_BETA_H_LUT = _build_lut(beta_h)
+
+	@njit
+	def _rates(Vm):
+		return (
+			lookup(Vm, _ALPHA_N_LUT),
+			lookup(Vm, _BETA_N_LUT),
+			lookup(Vm, _M_INF_LUT),
+			lookup(Vm, _ALPHA_H_LUT),
+			lookup(Vm, _BETA_H_LUT),
+		)
+else:
+	@njit
+	def _rates(Vm):
+		aM = alpha_m(Vm)
+		return (
+			alpha_n(Vm),
+			beta_n(Vm),
+			aM / ( aM + beta_m(Vm) ),
+			alpha_h(Vm),
+			beta_h(Vm),
+		)
+
+
+def get_data(
+		pulse_amp,
+		pulse_start = 100.0,
+		pulse_end = 1100.0,
+		consts = HHE_consts,
+	):
+	'''
+	pack the stimulus and model constants into the parameter array read by `_rhs_cfunc`
+	layout:
+		[ I_amp, pulse_start, pulse_end, C_m, E_Na, E_K, E_L, g_Na, g_K, g_L ]
+	'''
+	return np.array([
+		pulse_amp,
+		pulse_start,
+		pulse_end,
+		consts[_C_m],
+		consts[_E_Na],
+		consts[_E_K],
+		consts[_E_L],
+		consts[_g_Na],
+		consts[_g_K],
+		consts[_g_L],
+	], dtype = np.float64)
+
+
+# signature numbalsoda expects for the RHS, `rhs(t, u, du, p)`
+# NOTE: same as `numbalsoda.lsoda_sig`, built here so that importing this module
+#	does not import numbalsoda
+_rhs_sig = types.void(
+	types.double,
+	types.CPointer(types.double),
+	types.CPointer(types.double),
+	types.CPointer(types.double),
+)
+
+# source of the cfunc RHS, with a slot for each entry of the `get_data` array.
+# `_rhs_cfunc` fills the slots with `p[i]`, `get_rhs_specialized` fills the model
+# constants with their values as literals, so LLVM can fold them instead of loading
+# from `p` every call
+_rhs_src = '''
+def _rhs(t, u, du, p):
+	Vm = u[0]
+	n = u[1]
+	h = u[2]
+
+	# constant pulse stimulus, same as `stimFunc_constPulse`
+	if (t > {1}) and (t < {2}):
+		I_A = {0}
+	else:
+		I_A = 0.0
+
+	aN, bN, mi, aH, bH = _rates(Vm)
+
+	# currents
+	I_K = {8} * n * n * ( Vm - {5} )
+	I_Na = {7} * mi * mi * mi * h * ( Vm - {4} )
+	I_L = {9} * ( Vm - {6} )
+
+	du[0] = ( I_A - I_K - I_Na - I_L ) / {3}
+	du[1] = ( aN * ( 1.0 - n ) ) - ( bN * n )
+	du[2] = ( aH * ( 1.0 - h ) ) - ( bH * h )
+'''
+
+def _compile_rhs(slots):
+	''' fill the slots of `_rhs_src` with the strings in `slots` and compile it as a cfunc '''
+	ns = {}
+	# `repr` of a non-finite float is a bare `inf` / `nan`
+	exec(_rhs_src.format(*slots), dict(globals(), inf = np.inf, nan = np.nan), ns)
+	return cfunc(_rhs_sig)(ns['_rhs'])
+
+_rhs_cfunc = _compile_rhs([ 'p[%d]' % i for i in range(10) ])
+
+
+# compiled specializations are kept for the most recent sets of model constants
+_rhs_specialized_maxsize = 16
+
+@lru_cache(maxsize = _rhs_specialized_maxsize)
+def _get_rhs_specialized(consts):
+	# the stimulus slots stay loads from `p`, so a sweep over the pulse reuses one compile
+	return _compile_rhs([ 'p[0]', 'p[1]', 'p[2]' ] + [ repr(x) for x in consts ])
+
+def get_rhs_specialized(data):
+	'''
+	compile (or fetch from cache) a cfunc RHS specialized for the model constants in
+	the parameter array `data` (as returned by `get_data`). the stimulus is still
+	read from `data`, so the result can be reused for any pulse. compiling takes a
+	few hundred ms, so this pays off when the same constants are solved many times
+	'''
+	return _get_rhs_specialized(tuple(float(x) for x in data[3:]))
+
+
+def compute(
+		pulse_amp,
+		pulse_start = 100.0,
+		pulse_end = 1100.0,
+		tmin = 0.0,
+		tmax = 1150.0,
+		dt = 0.01,
+		n_out = None,
+		T_out = None,
+		IC = None,
+		consts = HHE_consts,
+		rtol = 1.49012e-8,
+		atol = 1.49012e-8,
+		method = 'dop853',
+		return_dtype = np.float64,
+		specialize = False,
+		bln_plot = False,
+	):
+	'''
+	solve the Erisir model for a constant pulse stimulus (via numbalsoda)
+	`method` is one of:
+		'dop853'  :  8th order explicit Runge-Kutta, fewer RHS calls on the smooth
+		             stretches between spikes
+		'lsoda'   :  switches to a stiff solver when needed, use this if parameters
+		             push the model into a stiff regime
+	the solution is reported on `np.arange(tmin, tmax, dt)` unless one of
+		`n_out`  :  (optional) number of evenly spaced output points over [tmin, tmax]
+		`T_out`  :  (optional) increasing array of output times, e.g. a coarse grid
+		            joined with fine windows around the spikes for spike detection
+	is given. the integrator takes its own steps in between, so fewer output
+	points means less storage and fewer forced steps. the step limits scale with
+	the span over `dt`, so `dt` should stay a fine step size even for a coarse output
+	returns:
+		( <timePoints>, <solutions> )
+	where `solutions[:,i]` is ( V_m, n, h )[i]
+	NOTE: default tolerances match `odeint`, looser ones drift spike timing over long runs
+	NOTE: with `USE_RATE_LUT` the RHS is piecewise linear in V_m, with a kink every
+		`_V_lut_dV`, so tolerances much tighter than the table's interpolation error
+		are not reachable. around `rtol = atol = 1e-12` lsoda gives up (RuntimeError)
+	NOTE: dop853 only reports the solution at the points of `T`, and never steps
+		past one, so a fine output grid also caps its step size at the grid spacing
+	NOTE: `specialize` uses `get_rhs_specialized`, up to ~10% faster per solve
+		but with a compile for every new set of `consts` (the pulse is not compiled in)
+	NOTE: integration is always in double precision, `return_dtype` (e.g. `np.float32`,
+		or `ml_dtypes.bfloat16`) only sets how the returned trajectory is stored
+	'''
+	if IC is None:
+		IC = HHE_stable
+
+	IC = np.array(IC, dtype = np.float64)
+	if T_out is not None:
+		T = np.asarray(T_out, dtype = np.float64)
+	elif n_out is not None:
+		T = np.linspace(tmin, tmax, n_out)
+	else:
+		T = np.arange(tmin, tmax, dt)
+	data = get_data(pulse_amp, pulse_start, pulse_end, consts)
+
+	if specialize:
+		rhs = get_rhs_specialized(data)
+	else:
+		rhs = _rhs_cfunc
+
+	# importing numbalsoda compiles its solvers, which takes several seconds,
+	# so it is only done once a solve is actually requested
+	from numbalsoda import lsoda, dop853
+
+	if method == 'dop853':
+		# `mxstep` is a limit on the total number of steps for dop853,
+		# sized from `dt` so that it does not shrink with a coarse output grid
+		mxstep = 100 * max(len(T), int(( T[-1] - T[0] ) / dt))
+		Vy, success = dop853(
+			rhs.address, IC, T, data = data,
+			rtol = rtol, atol = atol, mxstep = mxstep,
+		)
+	elif method == 'lsoda':
+		# `mxstep` is a limit per output interval for lsoda (default 10000),
+		# sized from the longest interval so that gaps in a coarse grid fit
+		mxstep = max(10000, 100 * int(np.max(np.diff(T)) / dt))
+		Vy, success = lsoda(
+			rhs.address, IC, T, data = data,
+			rtol = rtol, atol = atol, mxstep = mxstep,
+		)
+	else:
+		raise ValueError('unknown method:  %s' % str(method))
+
+	if not success:
+		raise RuntimeError('%s failed to integrate the Erisir model' % method)
+
+	Vy = Vy.astype(return_dtype, copy = False)
+
+	if bln_plot:
+		fig, ax = plt.subplots(figsize=(12, 7))
+		ax.plot(T, Vy[:, 0])
+
+		# stimulus, shifted below the trace
+		Idv = eval_stim(stimFunc_constPulse(pulse_amp, pulse_start, pulse_end), T)
+		ax.plot(T, Idv - 57.5, 'r-')
+
+		ax.grid()
+		ax.set_xlabel('Time (ms)')
+		ax.set_ylabel('Vm (mV)')
+		ax.set_title('Erisir Model')
+		plt.show()
+
+	return T, Vy
+
+
+
+#* population model
+# state is stored structure-of-arrays, `[ V_m(N), n(N), h(N) ]`, so each term of
+# the RHS is one vector op over all N neurons rather than N scalar evaluations
+
+# order in which `compute_batch` reads the constants
+_batch_consts = [ _C_m, _E_Na, _E_K, _E_L, _g_Na, _g_K, _g_L ]
+
+# every neuron takes the same steps in the fixed-step integrator, so the
+# per-step control flow is shared across the batch and the inner loops over
+# neurons are plain arithmetic on contiguous rows, which LLVM can vectorize
+
+@njit(fastmath = True, boundscheck = False)
+def hh_rhs(Vm, n, h, I_A, consts, out):
+	'''
+	fused RHS for the population, one pass over the neurons with no temporaries
+	`Vm`, `n`, `h`, `I_A` have shape (N,), `consts` has shape (7,N) with rows in
+	`_batch_consts` order, and the derivatives are written to `out`, shape (3,N)
+	'''
+	for j in range(len(Vm)):
+		V = Vm[j]
+		n_j = n[j]
+		h_j = h[j]
+
+		aN, bN, mi, aH, bH = _rates(V)
+
+		# currents
+		I_K = consts[5, j] * n_j * n_j * ( V - consts[2, j] )
+		I_Na = consts[4, j] * mi * mi * mi * h_j * ( V - consts[1, j] )
+		I_L = consts[6, j] * ( V - consts[3, j] )
+
+		out[0, j] = ( I_A[j] - I_K - I_Na - I_L ) / consts[0, j]
+		out[1, j] = ( aN * ( 1.0 - n_j ) ) - ( bN * n_j )
+		out[2, j] = ( aH * ( 1.0 - h_j ) ) - ( bH * h_j )
+
+@njit(fastmath = True, boundscheck = False)
+def _axpy(out, y, a, k):
+	''' `out = y + a * k` without allocating '''
+	for i in range(y.shape[0]):
+		for j in range(y.shape[1]):
+			out[i, j] = y[i, j] + a * k[i, j]
+
+@njit(fastmath = True)
+def _rk4_batch(y0, T, stim_amps, pulse_start, pulse_end, consts, Vy):
+	'''
+	classic RK4 over the time grid `T`, starting from `y0` of shape (3,N)
+	the state at every timepoint is written to `Vy`, shape (len(T),3,N), which
+	can be lower precision than the float64 state used for the integration
+	'''
+	y = y0.copy()
+	y_tmp = np.empty_like(y)
+	k1 = np.empty_like(y)
+	k2 = np.empty_like(y)
+	k3 = np.empty_like(y)
+	k4 = np.empty_like(y)
+	no_stim = np.zeros_like(stim_amps)
+
+	Vy[0] = y
+	for k in range(len(T) - 1):
+		t = T[k]
+		h = T[k + 1] - t
+
+		# stimulus at t, t + h/2, t + h. at a pulse edge the endpoints take the
+		# limit from inside the step, so a step starting at `pulse_start` or
+		# ending at `pulse_end` sees the pulse over its whole length
+		I_0 = stim_amps if (t >= pulse_start) and (t < pulse_end) else no_stim
+		I_1 = stim_amps if (t + 0.5 * h > pulse_start) and (t + 0.5 * h < pulse_end) else no_stim
+		I_2 = stim_amps if (t + h > pulse_start) and (t + h <= pulse_end) else no_stim
+
+		hh_rhs(y[0], y[1], y[2], I_0, consts, k1)
+		_axpy(y_tmp, y, 0.5 * h, k1)
+		hh_rhs(y_tmp[0], y_tmp[1], y_tmp[2], I_1, consts, k2)
+		_axpy(y_tmp, y, 0.5 * h, k2)
+		hh_rhs(y_tmp[0], y_tmp[1], y_tmp[2], I_1, consts, k3)
+		_axpy(y_tmp, y, h, k3)
+		hh_rhs(y_tmp[0], y_tmp[1], y_tmp[2], I_2, consts, k4)
+
+		for i in range(y.shape[0]):
+			for j in range(y.shape[1]):
+				y[i, j] += ( h / 6.0 ) * ( k1[i, j] + 2.0 * k2[i, j] + 2.0 * k3[i, j] + k4[i, j] )
+		Vy[k + 1] = y
+
+# neurons per block in `rk4_hh`, enough to fill the vector lanes
+_rk4_block = 16
+
+@njit(parallel = True, fastmath = True)
+def rk4_hh(y0, T, stim_amps, pulse_start, pulse_end, consts, Vy):
+	'''
+	fixed-step RK4 for the population, same arguments as `_rk4_batch`
+	neurons are independent, so the batch is split into blocks of `_rk4_block`
+	which are integrated over the whole time grid in parallel, with no
+	synchronization between steps
+	'''
+	N = y0.shape[1]
+	n_blocks = ( N + _rk4_block - 1 ) // _rk4_block
+
+	for b in prange(n_blocks):
+		j0 = b * _rk4_block
+		j1 = min(N, j0 + _rk4_block)
+		_rk4_batch(
+			y0[:, j0:j1], T,
+			stim_amps[j0:j1], pulse_start, pulse_end,
+			consts[:, j0:j1], Vy[:, :, j0:j1],
+		)
+
+def compute_batch(
+		stim_amps,
+		params = None,
+		pulse_start = 100.0,
+		pulse_end = 1100.0,
+		tmin = 0.0,
+		tmax = 1150.0,
+		dt = 0.01,
+		IC = None,
+		method = 'rk4',
+		return_dtype = np.float64,
+	):
+	'''
+	solve N independent Erisir neurons at once, for parameter scans
+	usage:
+		`stim_amps`  :  length-N array of constant pulse amplitudes, one per neuron
+		`params`     :  (optional) dict overriding `HHE_consts`, values can be scalars or length-N arrays
+		`IC`         :  (optional) initial conditions, shape (3,) shared or (3,N) per neuron
+		`method`     :  'rk4' for the compiled fixed-step integrator (step size `dt`),
+		                'odeint' for adaptive LSODA over the whole population
+		`return_dtype` : (optional) dtype the trajectories are stored in, e.g. `np.float32`
+		                to halve memory for large sweeps. integration stays in float64
+	returns:
+		( <timePoints>, <solutions> )
+	where `solutions` has shape (len(T), 3, N) and `solutions[:,i,j]` is ( V_m, n, h )[i] of neuron j
+	'''
+	stim_amps = np.asarray(stim_amps, dtype = np.float64)
+	N = len(stim_amps)
+
+	consts = deepcopy(HHE_consts)
+	if params is not None:
+		consts.update(params)
+
+	# every constant as a length-N array, rows in `_batch_consts` order
+	consts = np.array([
+		np.broadcast_to(np.asarray(consts[s], dtype = np.float64), (N,))
+		for s in _batch_consts
+	])
+
+	if IC is None:
+		IC = HHE_stable
+	IC = np.broadcast_to(np.asarray(IC, dtype = np.float64).reshape(3, -1), (3, N)).ravel()
+
+	T = np.arange(tmin, tmax, dt)
+
+	if method == 'rk4':
+		# float32 can be written directly by the kernel, anything else is cast afterwards
+		if np.dtype(return_dtype) in ( np.float32, np.float64 ):
+			Vy = np.empty((len(T), 3, N), dtype = return_dtype)
+			rk4_hh(IC.reshape(3, N), T, stim_amps, pulse_start, pulse_end, consts, Vy)
+		else:
+			Vy = np.empty((len(T), 3, N))
+			rk4_hh(IC.reshape(3, N), T, stim_amps, pulse_start, pulse_end, consts, Vy)
+			Vy = Vy.astype(return_dtype)
+		return T, Vy
+	elif method != 'odeint':
+		raise ValueError('unknown method:  %s' % str(method))
+
+	no_stim = np.zeros_like(stim_amps)
+	# output buffer, reused across calls since `odeint` copies the result
+	dy = np.empty((3, N))
+
+	def compute_derivatives(y, t, consts):
+		if (t > pulse_start) and (t < pulse_end):
+			I_A = stim_amps
+		else:
+			I_A = no_stim
+
+		hh_rhs(y[:N], y[N:2*N], y[2*N:], I_A, consts, dy)
+		return dy.ravel()
+
+	Vy = odeint(compute_derivatives, IC, T, args = (consts,))
+
+	return T, Vy.reshape(len(T), 3, N).astype(return_dtype, copy = False)
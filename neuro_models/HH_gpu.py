@@ -0,0 +1,151 @@
+'''
+Hodgkin-Huxley neuron model, batched on the GPU with torchdiffeq
+'''
+
+#%%
+
+import numpy as np
+import torch
+from torchdiffeq import odeint
+from copy import deepcopy
+
+from neuro_models.HH import (
+	HH_consts,
+	_C_m, _E_Na, _E_K, _E_L, _g_Na, _g_K, _g_L,
+	_V_m, _n_inf, _m_inf, _h_inf,
+)
+
+
+# torchdiffeq methods that take the `jump_t` option
+_adaptive_methods = ( 'dopri8', 'dopri5', 'bosh3', 'fehlberg2', 'adaptive_heun' )
+
+# order in which `HH_torch` reads the constants
+_batch_consts = [ _C_m, _E_Na, _E_K, _E_L, _g_Na, _g_K, _g_L ]
+
+
+class HH_torch(torch.nn.Module):
+	'''
+	RHS for N independent Hodgkin-Huxley neurons
+	state has shape (N,4), columns are ( V_m, n, m, h )
+	'''
+
+	def __init__(
+			self,
+			stim_amps,
+			consts,
+			pulse_start = 100.0,
+			pulse_end = 1100.0,
+		):
+		'''
+		stim_amps  :  tensor of constant pulse amplitudes, shape (N,)
+		consts     :  dict mapping each symbol in `_batch_consts` to a scalar or shape (N,) tensor
+		'''
+		super().__init__()
+		self.stim_amps = stim_amps
+		self.pulse_start = pulse_start
+		self.pulse_end = pulse_end
+
+		self.C_m, self.E_Na, self.E_K, self.E_L, self.g_Na, self.g_K, self.g_L = [
+			consts[s] for s in _batch_consts
+		]
+
+	def forward(self, t, y):
+		V, n, m, h = y.unbind(-1)
+
+		stim_on = (t > self.pulse_start) & (t < self.pulse_end)
+		I_A = torch.where(stim_on, self.stim_amps, torch.zeros_like(self.stim_amps))
+
+		# rate functions
+		aN = -0.01 * ( V + 55.0 ) / torch.expm1( -( V + 55.0 ) / 10.0 )
+		bN = 0.125 * torch.exp( -( V + 65.0 ) / 80.0 )
+		aM = -0.1 * ( V + 40.0 ) / torch.expm1( -( V + 40.0 ) / 10.0 )
+		bM = 4.0 * torch.exp( -( V + 65.0 ) / 18.0 )
+		aH = 0.07 * torch.exp( -( V + 65.0 ) / 20.0 )
+		bH = 1.0 / ( torch.exp( -( V + 35.0 ) / 10.0 ) + 1.0 )
+
+		# currents
+		I_K = self.g_K * ( n ** 4 ) * ( V - self.E_K )
+		I_Na = self.g_Na * ( m ** 3 ) * h * ( V - self.E_Na )
+		I_L = self.g_L * ( V - self.E_L )
+
+		dv = ( I_A - I_K - I_Na - I_L ) / self.C_m
+		dn = ( aN * ( 1.0 - n ) ) - ( bN * n )
+		dm = ( aM * ( 1.0 - m ) ) - ( bM * m )
+		dh = ( aH * ( 1.0 - h ) ) - ( bH * h )
+
+		return torch.stack([ dv, dn, dm, dh ], -1)
+
+
+def compute_batch(
+		stim_amps,
+		params = None,
+		pulse_start = 100.0,
+		pulse_end = 1100.0,
+		tmin = 0.0,
+		tmax = 1150.0,
+		dt = 0.01,
+		IC = None,
+		method = 'dopri5',
+		rtol = 1.0e-7,
+		atol = 1.0e-9,
+		device = None,
+		dtype = torch.float64,
+		return_dtype = np.float64,
+	):
+	'''
+	solve N independent Hodgkin-Huxley neurons at once, for large parameter scans
+	only worth it for large N (roughly N >= 1000), for a single neuron use `NM_model.solve`
+	usage:
+		`stim_amps`  :  length-N array of constant pulse amplitudes, one per neuron
+		`params`     :  (optional) dict overriding `HH_consts`, values can be scalars or length-N arrays
+		`IC`         :  (optional) initial conditions, shape (4,) shared or (N,4) per neuron
+		                defaults to rest at -65 mV
+		`method`     :  any `torchdiffeq.odeint` method
+		`device`     :  (optional) torch device, defaults to cuda when available
+		`return_dtype` : (optional) dtype the returned trajectories are stored in, e.g. `np.float32`
+	returns:
+		( <timePoints>, <solutions> )
+	where `solutions` has shape (len(T), 4, N) and `solutions[:,i,j]` is ( V_m, n, m, h )[i] of neuron j
+	'''
+	if device is None:
+		device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+	stim_amps = torch.as_tensor(np.asarray(stim_amps), dtype = dtype, device = device)
+	N = len(stim_amps)
+
+	consts = deepcopy(HH_consts)
+	if params is not None:
+		consts.update(params)
+	consts = {
+		s : torch.as_tensor(np.asarray(consts[s], dtype = np.float64), dtype = dtype, device = device)
+		for s in _batch_consts
+	}
+
+	if IC is None:
+		# gating variables at their steady state for the resting potential
+		V_rest = -65.0
+		IC = [ V_rest ] + [ float(x.subs(_V_m, V_rest)) for x in (_n_inf, _m_inf, _h_inf) ]
+	y0 = torch.as_tensor(np.asarray(IC, dtype = np.float64), dtype = dtype, device = device)
+	y0 = y0.expand(N, 4).contiguous()
+
+	T = np.arange(tmin, tmax, dt)
+
+	f = HH_torch(stim_amps, consts, pulse_start, pulse_end)
+
+	# adaptive solvers need to know where the stimulus switches,
+	# otherwise a large step across the pulse onset blows up the whole batch
+	options = None
+	if method in _adaptive_methods:
+		options = dict(jump_t = torch.tensor([ pulse_start, pulse_end ], dtype = dtype, device = device))
+
+	with torch.no_grad():
+		Vy = odeint(
+			f, y0,
+			torch.as_tensor(T, dtype = dtype, device = device),
+			method = method,
+			rtol = rtol,
+			atol = atol,
+			options = options,
+		)
+
+	return T, Vy.permute(0, 2, 1).cpu().numpy().astype(return_dtype, copy = False)
@@ -96,11 +96,11 @@ _n_inf, _m_inf, _tau_n = sym.symbols('n_inf m_inf tau_n')
 
 
 # Potassium ion-channel rate functions
-_alpha_n = - 0.01 * ( _V_m + 55.0 )/( sym.exp(-( _V_m + 55.0 )/10)-1)
+_alpha_n = - 0.01 * ( _V_m + 55.0 )/expm1(-( _V_m + 55.0 )/10)
 _beta_n = 0.125 * sym.exp(-( _V_m + 65.0 )/80)
 
 # Sodium ion-channel rate functions
-_alpha_m = -0.1 * ( _V_m + 40.0 ) / ( sym.exp(-(_V_m + 40.0)/10)-1 )
+_alpha_m = -0.1 * ( _V_m + 40.0 ) / expm1(-(_V_m + 40.0)/10)
 _beta_m = 4 * sym.exp(-( _V_m + 65 )/18)
 
 # leak channel rate values
@@ -117,8 +117,8 @@ _h_inf = _alpha_h / ( _alpha_h + _beta_h )
 # expressions
 
 # currents
-_I_K = _g_K * (_n ** 4.0) * ( _V_m - _E_K )
-_I_Na = _g_Na * ( _m ** 3.0 ) * _h * (_V_m - _E_Na)
+_I_K = _g_K * (_n ** 4) * ( _V_m - _E_K )
+_I_Na = _g_Na * ( _m ** 3 ) * _h * (_V_m - _E_Na)
 _I_L = _g_L * (_V_m - _E_L)
 
 # diffeqs
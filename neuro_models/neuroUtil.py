@@ -1,3 +1,4 @@
+import os
 import numpy as np
 
 from numba import njit
@@ -8,6 +9,8 @@ import scipy.optimize as sci_opt
 
 import sympy as sym
 import sympy.physics.units as u
+from sympy.utilities.autowrap import autowrap
+from sympy.codegen.cfunctions import expm1 as _expm1
 
 import matplotlib.pyplot as plt
 
@@ -29,6 +32,12 @@ _dt = 0.05
 
 
 
+#* use linearly interpolated lookup tables for voltage-dependent rates, where a model provides them
+# NOTE: read when the model module is imported, so set `neuroUtil.USE_RATE_LUT` before that
+USE_RATE_LUT = False
+
+
+
 #* physical consts
 # _R = spConst.R * u.joules / (u.mol * u.kelvin)
 # _F = spConst.physical_constants['Faraday constant'][0] * u.coulombs / u.mol
@@ -58,6 +67,18 @@ def check_unit(expr, unit):
 		raise ValueError('units should be \t %s, given %s' % ( str(unit), str(get_unit(expr)) ))
 
 
+class expm1(_expm1):
+	'''
+	`exp(x) - 1` that stays unevaluated for symbolic `x`
+	sympy's `expm1` collapses to `exp(x) - 1` whenever `x` has a numeric term (as
+	in `-(V_m + 55.0)/10`), which would lose the `expm1` call in generated code
+	'''
+	@classmethod
+	def eval(cls, arg):
+		if arg.is_Number:
+			return super().eval(arg)
+
+
  ######  ########  #### ##    ## ########
 ##    ## ##     ##  ##  ##   ##  ##
 ##       ##     ##  ##  ##  ##   ##
@@ -96,12 +117,17 @@ def get_first_index_ub(A, k):
 
 
 #* stim funcs
+# NOTE: these all accept either a single time or an ndarray of times
+
 def stimFunc_constPulse(
 		pulse_amp,
 		pulse_start = 100,
 		pulse_end = 1100,
 	):
 	def stim(t):
+		if isinstance(t, np.ndarray):
+			return np.where((t > pulse_start) & (t < pulse_end), pulse_amp, 0.0)
+
 		if (t > pulse_start) and (t < pulse_end):
 			return pulse_amp
 		else:
@@ -117,6 +143,14 @@ def stimFunc_regPulse(
 		pulse_start = 100.0,
 	):
 	def stim(t):
+		if isinstance(t, np.ndarray):
+			return np.where(
+				(t >= pulse_start)
+				& (t <= (pulse_start + pulse_count * pulse_delay + pulse_len))
+				& (( (t - pulse_start) % pulse_delay ) < pulse_len),
+				pulse_amp, 0.0,
+			)
+
 		if t < pulse_start:
 			return 0.0
 		elif t > (pulse_start + pulse_count * pulse_delay + pulse_len):
@@ -137,6 +171,13 @@ def stimFunc_pulseList(lst_pulses):
 	NOTE: assumed to be sorted by time, and disjoint
 	'''
 	def stim(t):
+		if isinstance(t, np.ndarray):
+			# go backwards so the first matching pulse wins, as in the scalar case
+			I = np.zeros(t.shape)
+			for p in lst_pulses[::-1]:
+				I = np.where((t > p[0]) & (t < p[0] + p[2]), p[1], I)
+			return I
+
 		for p in lst_pulses:
 			if t > p[0]:
 				if t < p[0] + p[2]:
@@ -147,6 +188,21 @@ def stimFunc_pulseList(lst_pulses):
 	return stim
 
 
+def eval_stim(stim, T):
+	'''
+	evaluate the stimulus function `stim` at every time in the array `T`
+	`stim` should accept an ndarray (the `stimFunc_*` functions do), scalar-only
+	functions fall back to `np.vectorize`, and functions that ignore `t`
+	(like `lambda t : I_app`) are broadcast
+	'''
+	try:
+		Idv = np.asarray(stim(T), dtype = float)
+	except (ValueError, TypeError):
+		return np.vectorize(stim, otypes = [float])(T)
+
+	return np.broadcast_to(Idv, T.shape)
+
+
 
  #######  ########        ##
 ##     ## ##     ##       ##
@@ -213,6 +269,8 @@ class NM_model(object):
 
 		self.model_exprs_subs = None
 		self.model_funcs = None
+		self.model_rhs = None
+		self.model_rhs_c = None
 
 
 
@@ -250,14 +308,48 @@ class NM_model(object):
 		for temp_expr in self.model_exprs_subs:
 			temp_func = sym.lambdify(self.lst_vars + [ self.stim_sym ], temp_expr)
 			self.model_funcs.append(temp_func)
+
+	def get_rhs(self):
+		'''
+		lambdify the whole system into a single function and compile it with numba
+		takes the same arguments as the functions from `get_funcs`, but returns
+		a tuple of all the derivatives, so one call evaluates the entire RHS
+		NOTE: not cached to disk, since lambdified functions have no source file
+		'''
+		temp_func = sym.lambdify(
+			self.lst_vars + [ self.stim_sym ],
+			tuple(self.model_exprs_subs),
+			modules = 'math',
+		)
+		self.model_rhs = njit(fastmath = True)(temp_func)
+
+	def get_rhs_c(self, tempdir = None):
+		'''
+		compile the whole system to C via cython (`sympy.utilities.autowrap`)
+		takes the same arguments as `model_rhs`, returns the derivatives as a (sys_N,1) array
+		needs cython and a C compiler. recompiles on every call, the generated
+		sources and build files go to a fresh temporary directory, or are kept
+		in `tempdir` if given (which should not be shared between processes)
+		'''
+		if tempdir is not None:
+			os.makedirs(tempdir, exist_ok = True)
+
+		self.model_rhs_c = autowrap(
+			sym.ImmutableMatrix(self.model_exprs_subs),
+			args = self.lst_vars + [ self.stim_sym ],
+			backend = 'cython',
+			tempdir = tempdir,
+		)
 		
 	def solve(
 			self,
 			IC = None,
 			T = np.arange( _t_min, _t_max, _dt ), 
+			backend = 'numba',
 		):
 		'''
 		solve the model for the given initial conditions and timesteps
+		`backend` picks the compiled RHS, 'numba' (`get_rhs`) or 'cython' (`get_rhs_c`)
 		returns:
 			( <timePoints>, <solutions>, <initial_conditions_used> )
 		'''
@@ -273,22 +365,24 @@ class NM_model(object):
 		if self.model_exprs_subs is None:
 			self.subs_model()
 		
-		if self.model_funcs is None:
-			self.get_funcs()
+		if backend == 'numba':
+			if self.model_rhs is None:
+				self.get_rhs()
+			rhs = self.model_rhs
+		elif backend == 'cython':
+			if self.model_rhs_c is None:
+				self.get_rhs_c()
+			rhs = self.model_rhs_c
+		else:
+			raise ValueError('unknown backend:  %s' % str(backend))
+
+		# output buffer, reused across calls since `odeint` copies the result
+		_dy = np.full((len(IC),), np.nan, dtype = float)
 
 		# compute the derivatives for each of the functions
 		def _compute_derivatives(_y, _t):
-			_dy = np.full((len(IC),), np.nan, dtype = float)
-			
-			for idx in range(self.sys_N):
-				# list of arguments to pass to the function
-				# 	list of derivatives, applied current at this timepoint
-				# 	plus I_A
-				lst_args_temp = list(_y) + [ self.stim_func( _t ) ]
-
-				# compute and store derivative
-				# print('%d \t %s \t %s' % (idx, str(lst_args_temp), (str(self.model_funcs[idx]( *lst_args_temp )) )))
-				_dy[idx] = self.model_funcs[idx]( *lst_args_temp )
+			# arguments are the current state, plus I_A at this timepoint
+			_dy[:] = np.ravel(rhs( *_y, self.stim_func( _t ) ))
 
 			return _dy
 
@@ -429,7 +523,7 @@ class NM_model(object):
 		# stimulus
 		if plot_stim:
 			ax2 = ax.twinx()
-			Idv = [ self.stim_func(t) for t in self.sln[0] ]
+			Idv = eval_stim(self.stim_func, self.sln[0])
 			ax2.plot(self.sln[0], Idv, 'r-')
 			ax2.set_ylabel(r'Stimulus Current density (uA/$cm^2$)')
 
@@ -680,6 +774,11 @@ class NM_model(object):
 		(X,Y) = np.meshgrid(*sp)
 		
 		# vector valued fctn
+		# make sure model is evaluated and lambdified, `solve` only compiles the fused RHS
+		if self.model_exprs_subs is None:
+			self.subs_model()
+		if self.model_funcs is None:
+			self.get_funcs()
 		u = self.model_funcs[idx_x](X,Y,I_app)
 		v = self.model_funcs[idx_y](Y,Y,I_app)
 		